@@ -0,0 +1,266 @@
+import argparse
+import sys
+import time
+import h5py
+import numpy as np
+import tensorflow as tf
+
+from prep_stead_data import normalise_waveforms, read_scale_factors, read_waveforms
+
+
+def batch_sta_lta(waveforms, nsta, nlta):
+    """ Same as ObsPy's classic_sta_lta, but for a whole batch of waveforms
+    (events, samples, channels) at once """
+
+    sta = np.cumsum(waveforms.astype(np.float64) ** 2, axis=1)
+    lta = sta.copy()
+
+    sta[:, nsta:] = sta[:, nsta:] - sta[:, :-nsta]
+    sta /= nsta
+    lta[:, nlta:] = lta[:, nlta:] - lta[:, :-nlta]
+    lta /= nlta
+
+    sta[:, :nlta - 1] = 0
+
+    dtiny = np.finfo(0.0).tiny
+    lta[lta < dtiny] = dtiny
+
+    return sta / lta
+
+
+def sta_lta_scores(waveforms, sampling_rate=100.0, sta_length=0.5, lta_length=5.0):
+    """ Max STA/LTA ratio for each window, over all samples and channels """
+
+    ratio = batch_sta_lta(waveforms, int(sta_length * sampling_rate), int(lta_length * sampling_rate))
+
+    return np.max(ratio, axis=(1, 2))
+
+
+def classifier_scores(classifier, waveforms, batch_size=128):
+    """ Event probability for each window, from the classifier in 2_event_classification """
+
+    return classifier.predict(waveforms, batch_size=batch_size, verbose=0)[:, 0]
+
+
+def picker_detections(predictions, pick_threshold=0.5):
+    """ A window counts as a detection if the P or S probability reaches the threshold """
+
+    return np.max(predictions[:, :, :2], axis=(1, 2)) >= pick_threshold
+
+
+def cascade_detect(waveforms, gate, picker, gate_threshold, scale_factors=None, batch_size=128, timings=None):
+    """ Run the phase picker only on windows where the gate score passes the threshold.
+
+    Takes raw waveforms (events, samples, channels), and normalises each
+    channel to unit peak amplitude first, as for training, so thresholds
+    chosen with evaluate_cascade carry over. scale_factors (e.g. from
+    read_scale_factors) saves computing the peak amplitudes.
+
+    Returns the gate scores, a mask of the windows passed on, and the picker
+    predictions for those windows. If a timings dict is given, the seconds
+    spent in the gate and the picker are added to its 'gate' and 'picker'.
+    """
+
+    waveforms = normalise_waveforms(waveforms, scale_factors)
+
+    start = time.perf_counter()
+    scores = gate(waveforms)
+    gate_time = time.perf_counter() - start
+
+    passed = scores >= gate_threshold
+
+    start = time.perf_counter()
+    predictions = np.zeros(shape=(0, waveforms.shape[1], 3), dtype=np.float32)
+    if np.any(passed):
+        predictions = picker.predict(waveforms[passed], batch_size=batch_size, verbose=0)
+    picker_time = time.perf_counter() - start
+
+    if timings is not None:
+        timings['gate'] = timings.get('gate', 0.0) + gate_time
+        timings['picker'] = timings.get('picker', 0.0) + picker_time
+
+    return scores, passed, predictions
+
+
+def run_cascade(filename, picker, gate, gate_threshold, channels='Z', max_events=None,
+                block_size=1024, batch_size=128, pick_threshold=0.5):
+    """ Cascaded detection over a file, at a fixed gate threshold.
+
+    Returns a mask of the windows detected by the picker (windows the gate
+    skipped count as not detected).
+    """
+
+    detections = []
+    timings = {}
+
+    with h5py.File(filename, 'r') as fin:
+
+        waveforms = fin.get('waveforms')
+        num_events = len(waveforms) if max_events is None else min(max_events, len(waveforms))
+
+        for istart in range(0, num_events, block_size):
+
+            istop = min(istart + block_size, num_events)
+
+            _, passed, predictions = cascade_detect(
+                read_waveforms(waveforms, channels, istart, istop),
+                gate,
+                picker,
+                gate_threshold,
+                scale_factors=read_scale_factors(fin, channels, istart, istop),
+                batch_size=batch_size,
+                timings=timings
+            )
+
+            block_detections = np.zeros(shape=(istop - istart), dtype=bool)
+            block_detections[passed] = picker_detections(predictions, pick_threshold)
+            detections.append(block_detections)
+
+    detections = np.concatenate(detections)
+
+    print(f'{num_events} windows from {filename}, gate threshold {gate_threshold:.3g}')
+    print(f'Gate:   {timings["gate"]:.1f} s')
+    print(f'Picker: {timings["picker"]:.1f} s')
+    print(f'Detected {np.sum(detections)} windows')
+
+    return detections
+
+
+def evaluate_cascade(filename, picker, gate, thresholds, channels='Z', max_events=None,
+                     block_size=1024, batch_size=128, pick_threshold=0.5):
+    """ Compare cascaded detection against running the picker on every window.
+
+    For each gate threshold, reports the fraction of windows the picker is
+    spared, and the recall lost relative to the picker on its own. The picker
+    is deterministic per window, so its predictions on all windows also give
+    the cascade's result for any threshold.
+    """
+
+    scores = []
+    detections = []
+    labels = []
+    timings = {}
+
+    with h5py.File(filename, 'r') as fin:
+
+        waveforms = fin.get('waveforms')
+        event_types = fin.get('type')
+
+        num_events = len(waveforms) if max_events is None else min(max_events, len(waveforms))
+
+        for istart in range(0, num_events, block_size):
+
+            istop = min(istart + block_size, num_events)
+
+            # Let every window through, to get the picker's result on all of them
+            block_scores, _, predictions = cascade_detect(
+                read_waveforms(waveforms, channels, istart, istop),
+                gate,
+                picker,
+                -np.inf,
+                scale_factors=read_scale_factors(fin, channels, istart, istop),
+                batch_size=batch_size,
+                timings=timings
+            )
+
+            scores.append(block_scores)
+            detections.append(picker_detections(predictions, pick_threshold))
+
+            if event_types is not None:
+                labels.append(event_types[istart:istop] == 1)
+
+    gate_time = timings['gate']
+    picker_time = timings['picker']
+
+    scores = np.concatenate(scores)
+    detections = np.concatenate(detections)
+    labels = np.concatenate(labels) if labels else None
+
+    print(f'{num_events} windows from {filename}')
+    print(f'Gate:   {gate_time:.1f} s ({1e3 * gate_time / num_events:.2f} ms per window)')
+    print(f'Picker: {picker_time:.1f} s ({1e3 * picker_time / num_events:.2f} ms per window)')
+    print(f'Picker alone detects {np.sum(detections)} windows')
+    if labels is not None:
+        print(f'Picker alone recall (vs. labels): {np.sum(detections & labels) / max(np.sum(labels), 1):.3f}')
+    print()
+
+    header = f'{"threshold":>10} {"skipped":>8} {"recall lost":>12} {"est. time":>10}'
+    if labels is not None:
+        header += f' {"recall (labels)":>16}'
+    print(header)
+
+    results = []
+    for threshold in thresholds:
+
+        passed = scores >= threshold
+        skipped = 1.0 - np.mean(passed)
+        kept = detections & passed
+        recall_lost = 1.0 - np.sum(kept) / max(np.sum(detections), 1)
+        est_time = gate_time + picker_time * (1.0 - skipped)
+
+        result = {
+            'threshold': threshold,
+            'skipped': skipped,
+            'recall_lost': recall_lost,
+            'est_time': est_time,
+        }
+
+        line = f'{threshold:>10.3g} {skipped:>8.3f} {recall_lost:>12.3f} {est_time:>9.1f}s'
+        if labels is not None:
+            result['recall'] = np.sum(kept & labels) / max(np.sum(labels), 1)
+            line += f' {result["recall"]:>16.3f}'
+        print(line)
+
+        results.append(result)
+
+    return results
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Evaluate a cheap gate in front of the phase picker')
+    parser.add_argument('filename', help='Input file, e.g. events_classification_ENZ_TEST.h5')
+    parser.add_argument('--picker', default='phase_picker.keras')
+    parser.add_argument('--gate', choices=['sta_lta', 'classifier'], default='sta_lta')
+    parser.add_argument('--classifier', default='event_classifier.keras',
+                        help='Model saved from 2_event_classification, for --gate classifier')
+    parser.add_argument('--thresholds', type=float, nargs='+', default=None,
+                        help='Gate thresholds to evaluate')
+    parser.add_argument('--threshold', type=float, default=None,
+                        help='Run the cascade at this gate threshold, instead of evaluating')
+    parser.add_argument('--channels', default='Z', help="Channels to read, e.g. 'Z' from an ENZ file")
+    parser.add_argument('--max-events', type=int, default=None)
+    parser.add_argument('--pick-threshold', type=float, default=0.5)
+    args = parser.parse_args()
+
+    picker = tf.keras.models.load_model(args.picker)
+
+    if args.gate == 'sta_lta':
+        gate = sta_lta_scores
+        thresholds = args.thresholds or [2.0, 3.0, 4.0, 5.0, 6.0, 8.0, 10.0]
+    else:
+        classifier = tf.keras.models.load_model(args.classifier)
+        gate = lambda waveforms: classifier_scores(classifier, waveforms)
+        thresholds = args.thresholds or [0.05, 0.1, 0.2, 0.3, 0.5, 0.7]
+
+    if args.threshold is not None:
+        run_cascade(
+            args.filename,
+            picker,
+            gate,
+            args.threshold,
+            channels=args.channels,
+            max_events=args.max_events,
+            pick_threshold=args.pick_threshold,
+        )
+        sys.exit()
+
+    evaluate_cascade(
+        args.filename,
+        picker,
+        gate,
+        thresholds,
+        channels=args.channels,
+        max_events=args.max_events,
+        pick_threshold=args.pick_threshold,
+    )
@@ -0,0 +1,16 @@
+import argparse
+
+from prep_stead_data import add_trace_features
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Store per-trace scale factors and summary features in existing data files'
+    )
+    parser.add_argument('filenames', nargs='+', help='e.g. events_phases_Zonly_TRAIN.h5')
+    parser.add_argument('--block-size', type=int, default=1024, help='Events to process at a time')
+    args = parser.parse_args()
+
+    for filename in args.filenames:
+        add_trace_features(filename, args.block_size)
@@ -2,6 +2,179 @@ import csv
 import h5py
 import numpy as np
 
+# Component order of the waveforms in the STEAD files
+CHANNELS = 'ENZ'
+
+# Number of events per HDF5 chunk in the output files
+EVENTS_PER_CHUNK = 32
+
+SAMPLING_RATE = 100.0
+
+# Per-trace features stored next to the waveforms, one value per channel
+FEATURES = ['peak_amplitude', 'rms', 'dominant_frequency', 'snr']
+
+
+def write_waveforms(fout, waveforms, channels):
+    """ Write waveforms with one chunk per channel, so that reading a subset of
+    the channels (e.g. only Z from an ENZ file) only touches those bytes """
+
+    dset = fout.create_dataset(
+        'waveforms',
+        data=waveforms,
+        dtype=np.float32,
+        chunks=(min(EVENTS_PER_CHUNK, len(waveforms)), waveforms.shape[1], 1)
+    )
+    dset.attrs['channels'] = channels
+
+    return dset
+
+
+def file_channels(dset):
+    """ Channels in a waveforms dataset, e.g. 'ENZ' """
+
+    # Older files have no channels attribute, but are either Z only or ENZ
+    return dset.attrs.get('channels', 'Z' if dset.shape[-1] == 1 else CHANNELS)
+
+
+def channel_indices(dset, channels=None):
+    """ Positions of the requested channels (e.g. 'Z') in a waveforms dataset, in file order """
+
+    available = file_channels(dset)
+
+    if channels is None:
+        return list(range(len(available)))
+
+    missing = [c for c in channels if c not in available]
+    if missing:
+        raise ValueError(f'Channels {missing} not in file (has {available})')
+
+    # h5py needs increasing indices, so channels come out in file order
+    return sorted(available.index(c) for c in channels)
+
+
+def read_waveforms(dset, channels=None, start=None, stop=None):
+    """ Read events [start:stop] from a waveforms dataset, for the given channels only """
+
+    indices = channel_indices(dset, channels)
+
+    if indices == list(range(dset.shape[-1])):
+        return dset[start:stop]
+
+    # Contiguous selections are cheaper as a slice than as a list
+    if indices == list(range(indices[0], indices[-1] + 1)):
+        return dset[start:stop, :, indices[0]:indices[-1] + 1]
+
+    return dset[start:stop, :, indices]
+
+
+def trace_features(waveforms, p_start, sampling_rate=SAMPLING_RATE, noise_length=5.0, signal_length=3.0):
+    """ Summary features for each trace and channel, for waveforms (events, samples, channels).
+
+    The SNR is the RMS in the signal_length seconds after p_start over the
+    RMS in the noise_length seconds before it, and NaN for traces without a
+    P pick.
+    """
+
+    waveforms = waveforms.astype(np.float64)
+    num_samples = waveforms.shape[1]
+
+    peak_amplitude = np.max(np.abs(waveforms), axis=1)
+    rms = np.sqrt(np.mean(waveforms ** 2, axis=1))
+
+    # Strongest frequency in the spectrum, leaving out the zero frequency
+    spectrum = np.abs(np.fft.rfft(waveforms - np.mean(waveforms, axis=1, keepdims=True), axis=1))
+    frequencies = np.fft.rfftfreq(num_samples, d=1.0 / sampling_rate)
+    dominant_frequency = frequencies[np.argmax(spectrum[:, 1:], axis=1) + 1]
+
+    p_start = np.asarray(p_start, dtype=np.int64)[:, np.newaxis]
+    samples = np.arange(num_samples)[np.newaxis, :]
+    noise_mask = (samples >= p_start - int(noise_length * sampling_rate)) & (samples < p_start)
+    signal_mask = (samples >= p_start) & (samples < p_start + int(signal_length * sampling_rate))
+
+    def masked_rms(mask):
+        mask = mask[:, :, np.newaxis]
+        count = np.maximum(np.sum(mask, axis=1), 1)
+        return np.sqrt(np.sum(mask * waveforms ** 2, axis=1) / count)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        snr = masked_rms(signal_mask) / masked_rms(noise_mask)
+
+    valid = (p_start[:, 0] > 0) & np.any(noise_mask, axis=1)
+    snr[~valid] = np.nan
+
+    return {
+        'peak_amplitude': peak_amplitude,
+        'rms': rms,
+        'dominant_frequency': dominant_frequency,
+        'snr': snr,
+    }
+
+
+def write_trace_features(fout, waveforms, p_start, channels, block_size=1024, noise_length=5.0, signal_length=3.0):
+    """ Compute trace features and store them next to the waveforms in fout.
+
+    waveforms and p_start can be in-memory arrays or HDF5 datasets; either
+    way they are processed in blocks, to limit memory use.
+    """
+
+    num_events, _, num_channels = waveforms.shape
+
+    datasets = {}
+    for name in FEATURES:
+        if name in fout:
+            del fout[name]
+        datasets[name] = fout.create_dataset(name, shape=(num_events, num_channels), dtype=np.float32)
+        datasets[name].attrs['channels'] = channels
+
+    datasets['snr'].attrs['noise_length'] = noise_length
+    datasets['snr'].attrs['signal_length'] = signal_length
+
+    for istart in range(0, num_events, block_size):
+        istop = min(istart + block_size, num_events)
+        features = trace_features(
+            waveforms[istart:istop],
+            p_start[istart:istop],
+            noise_length=noise_length,
+            signal_length=signal_length
+        )
+        for name in FEATURES:
+            datasets[name][istart:istop] = features[name]
+
+
+def add_trace_features(filename, block_size=1024):
+    """ Add trace features to an existing _TRAIN.h5/_TEST.h5 file, reading
+    the waveforms back from the file """
+
+    with h5py.File(filename, 'r+') as fout:
+        waveforms = fout.get('waveforms')
+        write_trace_features(fout, waveforms, fout.get('p_start'), file_channels(waveforms), block_size)
+
+    print(f'Trace features written to {filename}')
+
+
+def normalise_waveforms(waveforms, scale_factors=None):
+    """ Scale each trace and channel to unit peak amplitude, using stored scale
+    factors (from read_scale_factors) if there are any """
+
+    if scale_factors is None:
+        scale_factors = np.max(np.abs(waveforms), axis=1, keepdims=True)
+
+    return waveforms / (scale_factors + 1e-8)
+
+
+def read_scale_factors(fin, channels=None, start=None, stop=None):
+    """ Stored peak amplitudes for events [start:stop], shaped to normalise
+    waveforms (events, samples, channels) by division. None if not in the file. """
+
+    peak_amplitude = fin.get('peak_amplitude')
+    if peak_amplitude is None:
+        return None
+
+    indices = channel_indices(fin.get('waveforms'), channels)
+
+    return np.expand_dims(peak_amplitude[start:stop][:, indices], axis=1)
+
+
 def prep_signal_plus_noise(output_name, num_train_events=1000, num_test_events=100, vertical_only=False):
 
     # Collect the contents of the flippin csv files
@@ -102,24 +275,30 @@ def prep_signal_plus_noise(output_name, num_train_events=1000, num_test_events=1
 
     print('Key errors:', errors)
 
+    channels = 'Z' if vertical_only else CHANNELS
+
     # Write train file
     train_file = output_name + '_TRAIN.h5'
     ftrain = h5py.File(train_file, 'w')
-    ftrain.create_dataset('waveforms', data=np.stack(data_out[:num_train_events]), dtype=np.float32)
+    train_waveforms = np.stack(data_out[:num_train_events])
+    write_waveforms(ftrain, train_waveforms, channels)
     ftrain.create_dataset('type', data=np.array(type_out[:num_train_events]), dtype=np.int8)
     ftrain.create_dataset('p_start', data=np.array(p_start_out[:num_train_events]), dtype=np.int16)
     ftrain.create_dataset('s_start', data=np.array(s_start_out[:num_train_events]), dtype=np.int16)
     ftrain.create_dataset('mag', data=np.array(mag_out[:num_train_events]), dtype=np.float16)
+    write_trace_features(ftrain, train_waveforms, np.array(p_start_out[:num_train_events]), channels)
     ftrain.close()
     
     # Write test file 
     test_file = output_name + '_TEST.h5'
     ftest = h5py.File(test_file, 'w')
-    ftest.create_dataset('waveforms', data=np.stack(data_out[num_train_events:]), dtype=np.float32)
+    test_waveforms = np.stack(data_out[num_train_events:])
+    write_waveforms(ftest, test_waveforms, channels)
     ftest.create_dataset('type', data=np.array(type_out[num_train_events:]), dtype=np.int8)
     ftest.create_dataset('p_start', data=np.array(p_start_out[num_train_events:]), dtype=np.int16)
     ftest.create_dataset('s_start', data=np.array(s_start_out[num_train_events:]), dtype=np.int16)
     ftest.create_dataset('mag', data=np.array(mag_out[num_train_events:]), dtype=np.float16)
+    write_trace_features(ftest, test_waveforms, np.array(p_start_out[num_train_events:]), channels)
     ftest.close()
 
     print(f'Output written to {train_file}, {test_file}')
@@ -186,22 +365,28 @@ def prep_signal(output_name, num_train_events=1000, num_test_events=100, vertica
 
     print('Key errors:', errors)
 
+    channels = 'Z' if vertical_only else CHANNELS
+
     # Write train file
     train_file = output_name + '_TRAIN.h5'
     ftrain = h5py.File(train_file, 'w')
-    ftrain.create_dataset('waveforms', data=np.stack(data_out[:num_train_events]), dtype=np.float32)
+    train_waveforms = np.stack(data_out[:num_train_events])
+    write_waveforms(ftrain, train_waveforms, channels)
     ftrain.create_dataset('p_start', data=np.array(p_start_out[:num_train_events]), dtype=np.int16)
     ftrain.create_dataset('s_start', data=np.array(s_start_out[:num_train_events]), dtype=np.int16)
     ftrain.create_dataset('mag', data=np.array(mag_out[:num_train_events]), dtype=np.float16)
+    write_trace_features(ftrain, train_waveforms, np.array(p_start_out[:num_train_events]), channels)
     ftrain.close()
     
     # Write test file 
     test_file = output_name + '_TEST.h5'
     ftest = h5py.File(test_file, 'w')
-    ftest.create_dataset('waveforms', data=np.stack(data_out[num_train_events:]), dtype=np.float32)
+    test_waveforms = np.stack(data_out[num_train_events:])
+    write_waveforms(ftest, test_waveforms, channels)
     ftest.create_dataset('p_start', data=np.array(p_start_out[num_train_events:]), dtype=np.int16)
     ftest.create_dataset('s_start', data=np.array(s_start_out[num_train_events:]), dtype=np.int16)
     ftest.create_dataset('mag', data=np.array(mag_out[num_train_events:]), dtype=np.float16)
+    write_trace_features(ftest, test_waveforms, np.array(p_start_out[num_train_events:]), channels)
     ftest.close()
 
     print(f'Output written to {train_file}, {test_file}')
@@ -211,8 +396,8 @@ if __name__ == '__main__':
     
     prep_signal_plus_noise('sample_events_Zonly', num_train_events=10, num_test_events=10, vertical_only=True)
 
-    prep_signal_plus_noise('events_classification_Zonly', 100000, 10000, vertical_only=True)
-
-    prep_signal('events_phases_Zonly', 100000, 10000, vertical_only=True)
+    # Three-component files. Z-only readers use these too, by asking for
+    # channels='Z' (only the Z chunks are then read from disk)
+    prep_signal_plus_noise('events_classification_ENZ', 100000, 10000)
 
-#    pick_events('events_ENZ.h5', 100000, 10000, vertical_only=False)
+    prep_signal('events_phases_ENZ', 100000, 10000)
@@ -0,0 +1,46 @@
+import os
+import subprocess
+import sys
+import tempfile
+import h5py
+import numpy as np
+
+from prep_stead_data import write_trace_features, write_waveforms
+
+
+def write_synthetic_file(filename, num_events=64, channels='ENZ', seed=42):
+    """ Small file in the same layout as the prep outputs, with random waveforms and picks """
+
+    rng = np.random.default_rng(seed=seed)
+
+    waveforms = rng.normal(size=(num_events, 6000, len(channels))).astype(np.float32)
+    p_start = rng.integers(500, 2000, num_events)
+
+    with h5py.File(filename, 'w') as fout:
+        write_waveforms(fout, waveforms, channels)
+        fout.create_dataset('type', data=np.ones(num_events), dtype=np.int8)
+        fout.create_dataset('p_start', data=p_start, dtype=np.int16)
+        fout.create_dataset('s_start', data=rng.integers(2500, 4000, num_events), dtype=np.int16)
+        write_trace_features(fout, waveforms, p_start, channels)
+
+
+if __name__ == '__main__':
+
+    # Quick check that multi-worker training runs end to end: two workers on a
+    # tiny file, compared against a single process. Extra arguments are passed
+    # on to train_phase_picker.py, e.g. --bfloat16.
+    with tempfile.TemporaryDirectory() as tmpdir:
+
+        filename = os.path.join(tmpdir, 'synthetic_ENZ_TRAIN.h5')
+        write_synthetic_file(filename)
+
+        subprocess.run([
+            sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'train_phase_picker.py'),
+            filename,
+            '--workers', '2',
+            '--batch-size', '8',
+            '--epochs', '2',
+            '--max-steps', '2',
+            '--compare-baseline',
+            '--output', os.path.join(tmpdir, 'model.keras'),
+        ] + sys.argv[1:], check=True)
@@ -0,0 +1,420 @@
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import h5py
+import numpy as np
+import scipy.signal
+import tensorflow as tf
+from tensorflow import keras
+
+from prep_stead_data import normalise_waveforms, read_scale_factors, read_waveforms
+
+
+def create_small_phasenet(num_outputs=3, num_channels=1):
+    """ Same model as in 3_phase_picker """
+
+    inputs = keras.layers.Input(shape=(6000, num_channels))
+
+    # Encoder
+    # Level 1
+    c1 = keras.layers.Conv1D(16, 9, padding='same', activation='relu')(inputs)
+    c1 = keras.layers.Conv1D(16, 9, padding='same', activation='relu')(c1)
+    p1 = keras.layers.MaxPooling1D(2)(c1)
+
+    # Level 2
+    c2 = keras.layers.Conv1D(32, 7, padding='same', activation='relu')(p1)
+    c2 = keras.layers.Conv1D(32, 7, padding='same', activation='relu')(c2)
+    p2 = keras.layers.MaxPooling1D(2)(c2)
+
+    # Bottleneck
+    c3 = keras.layers.Conv1D(64, 5, padding='same', activation='relu')(p2)
+    c3 = keras.layers.Conv1D(64, 5, padding='same', activation='relu')(c3)
+
+    # Decoder
+    # Level 2
+    u2 = keras.layers.UpSampling1D(2)(c3)
+    u2 = keras.layers.Concatenate()([u2, c2])
+    c4 = keras.layers.Conv1D(32, 7, padding='same', activation='relu')(u2)
+    c4 = keras.layers.Conv1D(32, 7, padding='same', activation='relu')(c4)
+
+    # Level 1
+    u1 = keras.layers.UpSampling1D(2)(c4)
+    u1 = keras.layers.Concatenate()([u1, c1])
+    c5 = keras.layers.Conv1D(16, 9, padding='same', activation='relu')(u1)
+    c5 = keras.layers.Conv1D(16, 9, padding='same', activation='relu')(c5)
+
+    # Output (kept in float32 also when training with bfloat16)
+    outputs = keras.layers.Conv1D(num_outputs, 1, activation='softmax', dtype='float32')(c5)
+
+    model = keras.Model(inputs=inputs, outputs=outputs, name='small_phasenet')
+
+    return model
+
+
+def create_bigger_phasenet(num_outputs=3, num_channels=1):
+    """ Same model as in 3_phase_picker """
+
+    inputs = keras.Input(shape=(6000, num_channels))
+
+    # First half of the network: downsampling inputs
+
+    # Entry block
+    x = keras.layers.Conv1D(32, 3, strides=2, padding="same")(inputs)
+    x = keras.layers.BatchNormalization()(x)
+    x = keras.layers.Activation("relu")(x)
+
+    previous_block_activation = x  # Set aside for residual (aka. skip) connection
+
+    # Blocks 1, 2, 3 are identical apart from the feature depth.
+    for filters in [64, 64, 64]:
+        x = keras.layers.Activation("relu")(x)
+        x = keras.layers.Conv1D(filters, 3, padding="same")(x)
+        x = keras.layers.BatchNormalization()(x)
+
+        x = keras.layers.Activation("relu")(x)
+        x = keras.layers.Conv1D(filters, 3, padding="same")(x)
+        x = keras.layers.BatchNormalization()(x)
+
+        x = keras.layers.MaxPooling1D(3, strides=2, padding="same")(x)
+
+        # Project residual, and add it
+        residual = keras.layers.Conv1D(filters, 1, strides=2, padding="same")(
+            previous_block_activation
+        )
+        x = keras.layers.add([x, residual])
+        previous_block_activation = x  # Set aside next residual
+
+    # Second half: upsampling inputs
+
+    for filters in [64, 64, 64, 32]:
+        x = keras.layers.Activation("relu")(x)
+        x = keras.layers.Conv1DTranspose(filters, 3, padding="same")(x)
+        x = keras.layers.BatchNormalization()(x)
+
+        x = keras.layers.Activation("relu")(x)
+        x = keras.layers.Conv1DTranspose(filters, 3, padding="same")(x)
+        x = keras.layers.BatchNormalization()(x)
+
+        x = keras.layers.UpSampling1D(2)(x)
+
+        # Project residual
+        residual = keras.layers.UpSampling1D(2)(previous_block_activation)
+        residual = keras.layers.Conv1D(filters, 1, padding="same")(residual)
+        x = keras.layers.add([x, residual])  # Add back residual
+        previous_block_activation = x  # Set aside next residual
+
+    # Get the correct output shape (kept in float32 also when training with bfloat16)
+    outputs = keras.layers.Conv1D(num_outputs, 3, activation="softmax", padding="same", dtype="float32")(x)
+
+    # Define the model
+    model = keras.Model(inputs, outputs)
+
+    return model
+
+
+MODELS = {
+    'small': create_small_phasenet,
+    'bigger': create_bigger_phasenet,
+}
+
+
+class ShardedHdf5DataGenerator:
+    """ Hdf5DataGenerator from 3_phase_picker, reading only one shard of the file.
+
+    The file is split into num_shards contiguous, disjoint blocks of equal
+    size (any remainder is dropped), so that every worker sees the same
+    number of batches per epoch.
+    """
+
+    def __call__(self, filename, batchsize, shard_index=0, num_shards=1, normalise=True, channels='Z'):
+
+        if isinstance(filename, bytes):
+            filename = filename.decode()    # Because of technical reasons
+        if isinstance(channels, bytes):
+            channels = channels.decode()
+
+        with h5py.File(filename, "r") as fin:
+
+            waveforms = fin.get('waveforms')
+            p_start = fin.get('p_start')
+            s_start = fin.get('s_start')
+
+            shard_size = len(waveforms) // num_shards
+            shard_start = shard_index * shard_size
+            shard_stop = shard_start + shard_size
+
+            waveform_length = waveforms.shape[1]
+
+            # This is where we create the distribution around the pick
+            pick_width = 100   # equals 1 sec
+            half_pick_width = pick_width // 2
+            pick = scipy.signal.windows.gaussian(pick_width, 12)
+
+            for istart in range(shard_start, shard_stop - batchsize + 1, batchsize):
+
+                istop = istart + batchsize
+
+                data = read_waveforms(waveforms, channels, istart, istop)
+                batch_p_start = p_start[istart:istop]
+                batch_s_start = s_start[istart:istop]
+
+                if normalise:
+                    data = normalise_waveforms(data, read_scale_factors(fin, channels, istart, istop))
+
+                targets = np.zeros(shape=(len(data), waveform_length, 3), dtype=np.float32)
+                targets[:, :, 2] = 1.0
+
+                for i in range(len(data)):
+
+                    p_pos = batch_p_start[i]
+                    s_pos = batch_s_start[i]
+
+                    # Ensure there is a valid pick, with room for the whole distribution
+                    if (p_pos > half_pick_width and s_pos > half_pick_width
+                            and max(p_pos, s_pos) + half_pick_width <= waveform_length):
+                        targets[i, p_pos - half_pick_width : p_pos + half_pick_width, 0] = pick
+                        targets[i, s_pos - half_pick_width : s_pos + half_pick_width, 1] = pick
+                        targets[i, :, 2] -= targets[i, :, 0] + targets[i, :, 1]
+
+                yield (data, targets)
+
+
+def make_dataset(filename, batch_size, shard_index, num_shards, channels):
+    """ Repeating dataset over one shard, in batches of batch_size """
+
+    dataset = tf.data.Dataset.from_generator(
+        ShardedHdf5DataGenerator(),
+        output_signature=(
+            tf.TensorSpec(shape=(batch_size, 6000, len(channels)), dtype=tf.float32, name='data'),
+            tf.TensorSpec(shape=(batch_size, 6000, 3), dtype=tf.float32, name='targets')
+        ),
+        args=(filename, batch_size, shard_index, num_shards, True, channels)
+    )
+
+    return dataset.repeat().prefetch(tf.data.AUTOTUNE)
+
+
+def available_cores():
+
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+
+def run_worker(args):
+    """ Train in this process, as worker args.worker_index of args.workers """
+
+    # Threading has to be set up before TensorFlow does any work
+    cores = available_cores()
+    cores_per_worker = max(1, len(cores) // args.workers)
+
+    if args.pin_cores and hasattr(os, 'sched_setaffinity'):
+        first = args.worker_index * cores_per_worker
+        os.sched_setaffinity(0, cores[first:first + cores_per_worker])
+
+    tf.config.threading.set_intra_op_parallelism_threads(args.intra_op_threads or cores_per_worker)
+    tf.config.threading.set_inter_op_parallelism_threads(args.inter_op_threads)
+
+    if args.bfloat16:
+        keras.mixed_precision.set_global_policy('mixed_bfloat16')
+
+    if args.workers > 1:
+        communication = tf.distribute.experimental.CommunicationOptions(
+            implementation=tf.distribute.experimental.CommunicationImplementation.RING
+        )
+        strategy = tf.distribute.MultiWorkerMirroredStrategy(communication_options=communication)
+    else:
+        strategy = tf.distribute.get_strategy()
+
+    # --batch-size is per worker, so every step trains on batch_size * workers events
+    global_batch_size = args.batch_size * strategy.num_replicas_in_sync
+
+    with h5py.File(args.filename, 'r') as fin:
+        num_events = len(fin.get('waveforms'))
+    steps_per_epoch = (num_events // args.workers) // args.batch_size
+    if args.max_steps is not None:
+        steps_per_epoch = min(steps_per_epoch, args.max_steps)
+
+    # Each worker builds its own dataset, over its own shard and already in
+    # per-worker batches, so nothing gets sharded or rebatched by TensorFlow
+    def dataset_fn(input_context):
+        return make_dataset(
+            args.filename,
+            input_context.get_per_replica_batch_size(global_batch_size),
+            input_context.input_pipeline_id,
+            input_context.num_input_pipelines,
+            args.channels
+        )
+
+    iterator = iter(strategy.distribute_datasets_from_function(dataset_fn))
+
+    with strategy.scope():
+        model = MODELS[args.model](num_channels=len(args.channels))
+        optimizer = keras.optimizers.Adam(args.learning_rate)
+
+    # Keras' fit() does not support MultiWorkerMirroredStrategy, so we write the
+    # training step ourselves. The optimizer sums the gradients over workers,
+    # so each worker scales its loss by the global batch size.
+    def step_fn(data, targets):
+
+        with tf.GradientTape() as tape:
+            predictions = model(data, training=True)
+            per_event_loss = tf.reduce_mean(keras.losses.categorical_crossentropy(targets, predictions), axis=1)
+            loss = tf.nn.compute_average_loss(per_event_loss, global_batch_size=global_batch_size)
+
+        gradients = tape.gradient(loss, model.trainable_variables)
+        optimizer.apply_gradients(zip(gradients, model.trainable_variables))
+
+        return loss
+
+    @tf.function
+    def train_step(iterator):
+        losses = strategy.run(step_fn, args=next(iterator))
+        return strategy.reduce(tf.distribute.ReduceOp.SUM, losses, axis=None)
+
+    is_chief = args.worker_index == 0
+    epoch_times = []
+
+    for epoch in range(args.epochs):
+
+        start = time.perf_counter()
+        total_loss = 0.0
+        for _ in range(steps_per_epoch):
+            total_loss += float(train_step(iterator))
+        epoch_times.append(time.perf_counter() - start)
+
+        if is_chief:
+            print(f'Epoch {epoch + 1}/{args.epochs}: loss {total_loss / steps_per_epoch:.4f}, '
+                  f'{epoch_times[-1]:.1f} s')
+
+    # All workers have to take part in saving, but only the chief keeps the result
+    if args.output is not None:
+        if is_chief:
+            model.save(args.output)
+        else:
+            tmpdir = tempfile.mkdtemp()
+            model.save(os.path.join(tmpdir, 'model.keras'))
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    if is_chief and args.result_file is not None:
+
+        # Skip the first epoch if we can, it includes graph tracing and warm-up
+        timed_epochs = epoch_times[1:] if len(epoch_times) > 1 else epoch_times
+        samples = len(timed_epochs) * steps_per_epoch * global_batch_size
+
+        with open(args.result_file, 'w') as fout:
+            json.dump({
+                'workers': args.workers,
+                'samples_per_second': samples / sum(timed_epochs),
+                'epoch_times': epoch_times,
+            }, fout)
+
+
+def free_ports(num):
+
+    sockets = [socket.socket() for _ in range(num)]
+    for s in sockets:
+        s.bind(('localhost', 0))
+    ports = [s.getsockname()[1] for s in sockets]
+    for s in sockets:
+        s.close()
+
+    return ports
+
+
+def launch(args, workers, output):
+    """ Start one training process per worker on localhost, and wait for them """
+
+    workers_hosts = [f'localhost:{port}' for port in free_ports(workers)]
+    fd, result_file = tempfile.mkstemp(suffix='.json')
+    os.close(fd)
+
+    worker_args = [
+        '--model', args.model,
+        '--channels', args.channels,
+        '--epochs', str(args.epochs),
+        '--batch-size', str(args.batch_size),
+        '--learning-rate', str(args.learning_rate),
+        '--inter-op-threads', str(args.inter_op_threads),
+        '--workers', str(workers),
+        '--result-file', result_file,
+    ]
+    if args.intra_op_threads is not None:
+        worker_args += ['--intra-op-threads', str(args.intra_op_threads)]
+    if args.max_steps is not None:
+        worker_args += ['--max-steps', str(args.max_steps)]
+    if args.bfloat16:
+        worker_args.append('--bfloat16')
+    if args.pin_cores:
+        worker_args.append('--pin-cores')
+    if output is not None:
+        worker_args += ['--output', output]
+
+    processes = []
+    for index in range(workers):
+
+        env = dict(os.environ)
+        env['TF_CONFIG'] = json.dumps({
+            'cluster': {'worker': workers_hosts},
+            'task': {'type': 'worker', 'index': index}
+        })
+
+        processes.append(subprocess.Popen(
+            [sys.executable, __file__, args.filename, '--worker-index', str(index)] + worker_args,
+            env=env
+        ))
+
+    failed = sum(p.wait() != 0 for p in processes)
+    if failed:
+        raise RuntimeError(f'{failed} of {workers} workers failed')
+
+    with open(result_file) as fin:
+        result = json.load(fin)
+    os.remove(result_file)
+
+    return result
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Data-parallel CPU training of the phase picker models')
+    parser.add_argument('filename', help='Training file, e.g. events_phases_ENZ_TRAIN.h5')
+    parser.add_argument('--model', choices=sorted(MODELS), default='small')
+    parser.add_argument('--channels', default='Z', help="Channels to read, e.g. 'Z' from an ENZ file")
+    parser.add_argument('--workers', type=int, default=2, help='Number of local worker processes')
+    parser.add_argument('--epochs', type=int, default=5)
+    parser.add_argument('--batch-size', type=int, default=128, help='Batch size per worker')
+    parser.add_argument('--learning-rate', type=float, default=1e-4)
+    parser.add_argument('--max-steps', type=int, default=None, help='Limit the steps per epoch')
+    parser.add_argument('--intra-op-threads', type=int, default=None,
+                        help='Threads per op in each worker (default: cores / workers)')
+    parser.add_argument('--inter-op-threads', type=int, default=2)
+    parser.add_argument('--pin-cores', action='store_true', help='Pin each worker to its own cores')
+    parser.add_argument('--bfloat16', action='store_true', help='Train with bfloat16 mixed precision')
+    parser.add_argument('--compare-baseline', action='store_true',
+                        help='Also train in a single process, and report the scaling efficiency')
+    parser.add_argument('--output', default=None, help='Where to save the trained model')
+    parser.add_argument('--worker-index', type=int, default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--result-file', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker_index is not None:
+        run_worker(args)
+        sys.exit()
+
+    result = launch(args, args.workers, args.output)
+    print(f'{args.workers} workers: {result["samples_per_second"]:.1f} samples/s')
+
+    if args.compare_baseline:
+
+        baseline = launch(args, 1, None)
+        print(f'1 worker:  {baseline["samples_per_second"]:.1f} samples/s')
+
+        speedup = result['samples_per_second'] / baseline['samples_per_second']
+        print(f'Speedup: {speedup:.2f}x, scaling efficiency: {speedup / args.workers:.1%}')